@@ -59,7 +59,7 @@ export class IotSystemCdkStack extends Stack {
       removalPolicy: RemovalPolicy.RETAIN
     })
 
-    const dailyS3Lambda = this.aggregateMeasurementsS3(measurementsTable, locationTable, measurementsBucket);
+    const dailyS3Lambda = this.aggregateMeasurementsS3(measurementsTable, locationTable, measurementsBucket, adminNotificationTopic);
 
     const generateGraphLambda = new GenerateGraphLambda(this, "GenerateGraphLambda", {measurementsTable, locationTable, measurementsBucket});
 
@@ -151,7 +151,10 @@ export class IotSystemCdkStack extends Stack {
     return lambdaFunction;
   }
 
-  private aggregateMeasurementsS3(measurementsTable: TableV2, locationTable: Table, measurementsBucket: Bucket): Function {
+  private aggregateMeasurementsS3(measurementsTable: TableV2, locationTable: Table, measurementsBucket: Bucket, alertTopic: Topic): Function {
+    // Alert rules in the format of rules_from_config in AlertRules.py, from cdk.json
+    // or -c alertRules='[...]'. The lambda uses its default rules without them.
+    const alertRules = this.node.tryGetContext('alertRules');
     const lambda = new PythonFunction(this, 'aggregateMeasurementData', {
       functionName: "AggregateMeasurementData",
       entry: join(__dirname, 'lambdas'),
@@ -160,7 +163,9 @@ export class IotSystemCdkStack extends Stack {
       environment: {
         MEASUREMENTS_TABLE_NAME: measurementsTable.tableName,
         LOCATION_TABLE_NAME: locationTable.tableName,
-        BUCKET_NAME: measurementsBucket.bucketName
+        BUCKET_NAME: measurementsBucket.bucketName,
+        ALERT_TOPIC_ARN: alertTopic.topicArn,
+        ...(alertRules && { ALERT_RULES: typeof alertRules === 'string' ? alertRules : JSON.stringify(alertRules) })
       },
       memorySize: 1000,
       timeout: Duration.minutes(15)
@@ -169,6 +174,7 @@ export class IotSystemCdkStack extends Stack {
     measurementsTable.grantReadData(lambda);
     locationTable.grantReadData(lambda);
     measurementsBucket.grantReadWrite(lambda);
+    alertTopic.grantPublish(lambda);
 
     const dailyRule = new Rule(this, 'DailyS3DumpRule', {
       ruleName: "DailyS3Dump",
@@ -3,14 +3,23 @@ import json
 from datetime import date, datetime, timedelta
 import os
 
-import numpy as np
+import boto3
 from dao.LocationTable import LocationTable
+from dao.MeasurementHelper import merge_sorted
 from dao.MeasurementsBucket import MeasurementsBucket
 from dao.MeasurementsTable import MeasurementsTable
+from helpers.AlertRules import Finding, evaluate_rules, rules_from_config
+
+# SNS messages are limited to 256KB so only list this many findings
+MAXIMUM_FINDINGS_IN_NOTIFICATION = 500
 
 location_table = LocationTable(os.environ['LOCATION_TABLE_NAME'])
 measurements_table = MeasurementsTable(os.environ['MEASUREMENTS_TABLE_NAME'])
 measurements_bucket = MeasurementsBucket(os.environ['BUCKET_NAME'])
+alert_topic_arn = os.environ.get('ALERT_TOPIC_ARN')
+sns = boto3.client("sns")
+# A JSON list of rules, see rules_from_config. The defaults are used when unset.
+alert_rules = rules_from_config(os.environ.get('ALERT_RULES'))
 
 
 def handler(event, context):
@@ -47,11 +56,60 @@ def process_daily(devices: list[str], input_date: datetime | None):
         end = input_date + timedelta(days=1)
     start = end - timedelta(days=1)
 
+    # A re-run or late upload for a month that has already been closed has to
+    # correct the rollups that the monthly run built from it as well
+    closed_month = date(start.year, start.month, 1) < date.today().replace(day=1)
+
+    fleet_arrays = {}
+    findings = []
     for device in devices:
         daily_array = measurements_table.get_sensor_data(device, start, end)
         measurements_bucket.upload_day(device, start, daily_array)
+        fleet_arrays[device] = daily_array
+
+        # Check the data while we already have it rather than reading it again later
+        findings.extend(evaluate_rules(device, daily_array, start, end, alert_rules))
 
         append_day_to_month(device, start, daily_array)
+        if closed_month:
+            append_day_to_closed_year(device, start, daily_array)
+
+    measurements_bucket.upload_fleet_day(start, fleet_arrays)
+
+    # The device months have changed so the fleet month built from them is stale
+    if closed_month and measurements_bucket.fleet_month_exists(start):
+        print(f"Rebuilding the fleet month for {start.year}-{start.month:02d} since it has already been closed")
+        measurements_bucket.upload_fleet_month(start, devices)
+
+    notify_findings(start, findings)
+
+
+def notify_findings(date: datetime, findings: list[Finding]):
+    """
+    Send every finding for the run in a single notification.
+    """
+    if not findings:
+        print(f"No alert rules triggered for {date.date()}")
+        return
+
+    lines = [str(finding) for finding in findings[:MAXIMUM_FINDINGS_IN_NOTIFICATION]]
+    if len(findings) > MAXIMUM_FINDINGS_IN_NOTIFICATION:
+        lines.append(f"...and {len(findings) - MAXIMUM_FINDINGS_IN_NOTIFICATION} more")
+    message = "\n".join(lines)
+    print(f"{len(findings)} alert rules triggered for {date.date()}:\n{message}")
+
+    if alert_topic_arn is None:
+        print("ALERT_TOPIC_ARN is not set so not sending a notification")
+        return
+
+    try:
+        sns.publish(
+            TopicArn=alert_topic_arn,
+            Subject=f"PicoTherm: {len(findings)} alerts for {date.date()}",
+            Message=message
+        )
+    except Exception as e:
+        print(f"Failed to publish alerts: {e}")
 
 
 def append_day_to_month(device: str, date: datetime, daily_array):
@@ -61,12 +119,26 @@ def append_day_to_month(device: str, date: datetime, daily_array):
         # daily array on its own
         measurements_bucket.upload_month(device, date, daily_array)
     else:
-        # Check that we are not appending to a file that already contains this date
-        if monthly_array[-1][0] < daily_array[0][0]:
-            monthly_array = np.append(monthly_array, daily_array, axis=0)
+        # Merging rather than appending means re-runs and late uploads for a day
+        # already in the month replace or fill in that day's rows
+        monthly_array, changed = merge_sorted(monthly_array, daily_array)
+        if changed:
             measurements_bucket.upload_month(device, date, monthly_array)
         else:
-            print("Skipping since would append data that is already there")
+            print("Skipping since the month already contains this data")
+
+
+def append_day_to_closed_year(device: str, date: datetime, daily_array):
+    yearly_array = measurements_bucket.download_year(device, date)
+    if yearly_array is None:
+        # The monthly run has not built the year yet so it will pick the day up
+        # from the month
+        return
+    yearly_array, changed = merge_sorted(yearly_array, daily_array)
+    if changed:
+        measurements_bucket.upload_year(device, date, yearly_array)
+    else:
+        print("Skipping since the year already contains this data")
 
 
 def process_monthly(devices: list[str], input_date: datetime | None):
@@ -80,15 +152,21 @@ def process_monthly(devices: list[str], input_date: datetime | None):
         start = date(input_date.year, input_date.month, 1)
         end = date(input_date.year, input_date.month, calendar.monthrange(start.year, start.month)[1])
 
+    # Only the row counts are kept so that the whole fleet's months are never
+    # in memory at once
+    row_counts = {}
     for device in devices:
         month_array = measurements_bucket.download_days_in_range(device, start.year, start.month, start.day, end.day)
 
         if month_array is not None:
             measurements_bucket.upload_month(device, start, month_array)
+            row_counts[device] = month_array.shape[0]
             append_month_to_year(device, start, month_array)
         else:
             print(f'No data found for device {device} for month {start}')
 
+    measurements_bucket.upload_fleet_month(start, list(row_counts), row_counts)
+
 
 def append_month_to_year(device: str, date: date, monthly_array):
     yearly_array = measurements_bucket.download_year(device, date)
@@ -97,12 +175,11 @@ def append_month_to_year(device: str, date: date, monthly_array):
         # monthly array on its own
         measurements_bucket.upload_year(device, date, monthly_array)
     else:
-        # Check that we are not appending to a file that already contains this date
-        if yearly_array[-1][0] < monthly_array[0][0]:
-            yearly_array = np.append(yearly_array, monthly_array, axis=0)
+        yearly_array, changed = merge_sorted(yearly_array, monthly_array)
+        if changed:
             measurements_bucket.upload_year(device, date, yearly_array)
         else:
-            print("Skipping since would append data that is already there")
+            print("Skipping since the year already contains this data")
 
 
 def process_yearly(devices: list[str], input_date: datetime | None):
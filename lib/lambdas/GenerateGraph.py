@@ -1,20 +1,27 @@
+import base64
 from datetime import datetime, timedelta
 import hashlib
 import io
+import json
 import os
+import struct
 
 import boto3
 import dateparser
 from matplotlib import pyplot as plt
-from matplotlib.dates import DateFormatter, HourLocator
+from matplotlib.dates import AutoDateLocator, ConciseDateFormatter, DateFormatter, HourLocator, date2num
 import numpy as np
 
 from dao.LocationTable import LocationTable
 from dao.MeasurementsTable import MeasurementsTable
 from dao.MeasurementsBucket import MeasurementsBucket
-from dao.MeasurementHelper import MeasurementHelper
+from dao.MeasurementHelper import MEASURES, MILLIS_PER_DAY, MILLIS_PER_HOUR, MeasurementHelper
 
 MOVAVG_RADIUS = 3
+OUTPUT_FORMATS = ("html", "heatmap", "json", "binary")
+# Lambda URL responses are limited to 6MB. Each point is about 14 bytes of JSON
+# or 11 bytes of base64 binary so this leaves plenty of room.
+MAXIMUM_DATA_POINTS = 200_000
 
 CORRECT_PASSWORD_HASH = os.environ['PASSWORD_HASH']
 LOCATION_TABLE_NAME = os.environ['LOCATION_TABLE_NAME']
@@ -51,6 +58,156 @@ def moving_average(x, w):
     return np.convolve(x, np.ones(w), 'valid') / w
 
 
+def hourly_heatmap(time_ms: np.ndarray, values: np.ndarray, first_day: int, day_count: int) -> np.ndarray:
+    """
+    Mean of the values in each hour as a day_count x 24 grid, where day 0 is
+    first_day counted in days since the epoch. Hours without data are NaN.
+    """
+    buckets = (time_ms // MILLIS_PER_HOUR).astype(np.int64) - first_day * 24
+    sums = np.bincount(buckets, weights=values, minlength=day_count * 24)
+    counts = np.bincount(buckets, minlength=day_count * 24)
+
+    with np.errstate(invalid="ignore"):
+        means = sums / counts
+    return means.reshape(day_count, 24)
+
+
+def get_heatmap_response(device_id, location, from_time, until_time, measure, title):
+    """
+    Day by hour of day grid of the hourly mean. Drawing it costs the same
+    however many measurements the range contains.
+    """
+    data = measurements_helper.get_data_in_range(device_id, from_time, until_time)
+
+    print(f"Downloaded data shape is {data.shape}")
+    if data.size == 0:
+        return get_error_page("No data was found for the given time.")
+
+    first_day = int(data[0, 0] // MILLIS_PER_DAY)
+    last_day = int(data[-1, 0] // MILLIS_PER_DAY)
+    day_count = last_day - first_day + 1
+    grid = hourly_heatmap(data[:, 0], data[:, MEASURES[measure]], first_day, day_count)
+    print(f"Drawing heatmap of {day_count} days from {data.shape[0]} measurements")
+
+    first_day_time = np.datetime64(first_day, "D")
+    fig, axis = plt.subplots(figsize=(12, 7))
+    image = axis.imshow(
+        grid.T,
+        aspect="auto",
+        origin="lower",
+        interpolation="nearest",
+        cmap="viridis",
+        extent=(float(date2num(first_day_time)), float(date2num(first_day_time + day_count)), 0, 24)
+    )
+    fig.colorbar(image, ax=axis).set_label(measure.capitalize(), fontsize=15)
+
+    locator = AutoDateLocator()
+    axis.xaxis.set_major_locator(locator)
+    axis.xaxis.set_major_formatter(ConciseDateFormatter(locator))
+    axis.set_yticks(range(0, 25, 3))
+    axis.set_ylabel("Hour (UTC)", fontsize=15)
+
+    plt.title(f"{location.capitalize()} {measure}", fontsize=20)
+    plt.tight_layout()
+
+    f = io.BytesIO()
+    plt.savefig(f, format="svg")
+    plt.close()
+
+    svg = f.getvalue().decode("utf-8")
+    svg = svg[svg.find('<svg'):]  # Remove stuff from before the svg
+    return {
+        "statusCode": 200,
+        "body": get_output_page(svg, title),
+        "headers": {
+            'Content-Type': 'text/html;charset=utf-8',
+        }
+    }
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if if_none_match is None:
+        return False
+    # If-None-Match uses the weak comparison so W/ prefixes are ignored
+    candidates = [candidate.strip().removeprefix("W/") for candidate in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates
+
+
+def get_data_response(device_id, from_time, until_time, period_seconds, output_format, if_none_match):
+    """
+    Resampled data for drawing the graph in the browser. The grid is aligned to
+    multiples of the period so that relative ranges like "1 day ago" give the
+    same result, and the same ETag, until the next period starts.
+    """
+    period_ms = int(period_seconds * 1000)
+    grid_start = -(-int(from_time.timestamp() * 1000) // period_ms) * period_ms
+    grid_end = int(until_time.timestamp() * 1000) // period_ms * period_ms
+
+    if grid_end <= grid_start:
+        return get_error_page("Not enough data points: time window too short or period too long.")
+
+    if (grid_end - grid_start) // period_ms + 1 > MAXIMUM_DATA_POINTS:
+        return get_error_page(f"Too many data points: the time window divided by the period must be at most {MAXIMUM_DATA_POINTS}.")
+
+    # Measurements rarely land exactly on the grid, so the data reaches one period
+    # past each end for the first and last points to have samples either side.
+    # It stops at the present since there is nothing later to read.
+    now = int(datetime.now().timestamp() * 1000)
+    fetch_start_time = datetime.fromtimestamp((grid_start - period_ms) / 1000)
+    fetch_end_time = datetime.fromtimestamp(max(grid_end, min(grid_end + period_ms, now)) / 1000)
+
+    version = measurements_helper.get_version(device_id, fetch_start_time, fetch_end_time)
+    etag = '"' + hashlib.sha256(f"{version}/{grid_start}/{grid_end}/{period_ms}/{output_format}".encode("utf-8")).hexdigest() + '"'
+    headers = {
+        "ETag": etag,
+        # Allow caching but always check the ETag first
+        "Cache-Control": "no-cache",
+    }
+
+    if etag_matches(if_none_match, etag):
+        print(f"ETag {etag} matches so returning 304")
+        return {
+            "statusCode": 304,
+            "headers": headers,
+        }
+
+    data = measurements_helper.get_data_in_range(device_id, fetch_start_time, fetch_end_time)
+    print(f"Downloaded data shape is {data.shape}")
+    if data.size == 0:
+        return get_error_page("No data was found for the given time.")
+
+    time = np.arange(grid_start, grid_end + 1, period_ms)
+    temperature = np.interp(time, data[:, 0], data[:, 1], left=np.nan, right=np.nan)
+    humidity = np.interp(time, data[:, 0], data[:, 2], left=np.nan, right=np.nan)
+
+    if output_format == "binary":
+        # Little endian int64 start, int64 period and uint32 count in milliseconds
+        # followed by count float32 temperatures then count float32 humidities.
+        # Points outside the data are NaN.
+        body = (struct.pack("<qqI", grid_start, period_ms, time.size)
+                + temperature.astype("<f4").tobytes() + humidity.astype("<f4").tobytes())
+        headers["Content-Type"] = "application/octet-stream"
+        return {
+            "statusCode": 200,
+            "body": base64.b64encode(body).decode("ascii"),
+            "isBase64Encoded": True,
+            "headers": headers,
+        }
+
+    # JSON has no NaN so points outside the data are null
+    headers["Content-Type"] = "application/json"
+    return {
+        "statusCode": 200,
+        "body": json.dumps({
+            "start": grid_start,
+            "period": period_ms,
+            "temperature": [None if np.isnan(t) else t for t in temperature.round(2).tolist()],
+            "humidity": [None if np.isnan(h) else h for h in humidity.round(2).tolist()],
+        }),
+        "headers": headers,
+    }
+
+
 dynamodb = boto3.resource("dynamodb")
 location_table = LocationTable(LOCATION_TABLE_NAME)
 measurements_helper = MeasurementHelper(MeasurementsTable(os.environ['MEASUREMENTS_TABLE_NAME']), MeasurementsBucket(os.environ['BUCKET_NAME']))
@@ -58,7 +215,10 @@ measurements_helper = MeasurementHelper(MeasurementsTable(os.environ['MEASUREMEN
 
 def handler(event, context):
     print("Received event:", event)
-    
+
+    # Lambda URLs give lower case header names
+    if_none_match = (event.get('headers') or {}).get('if-none-match')
+
     # If it is a lambda url extract the url params
     if 'queryStringParameters' in event:
         event = event['queryStringParameters']
@@ -68,9 +228,25 @@ def handler(event, context):
     from_input = event.get("from")
     until_input = event.get("until")
     period_input = event.get("period")
+    output_format = event.get("format", "html").lower()
+    measure = event.get("measure")
 
-    if None in (password, location, from_input, until_input, period_input):
-        return get_error_page("password, location, from, until, and period must be provided.")
+    if output_format not in OUTPUT_FORMATS:
+        return get_error_page(f"format must be one of {', '.join(OUTPUT_FORMATS)}.")
+
+    if None in (password, location, from_input, until_input):
+        return get_error_page("password, location, from, and until must be provided.")
+
+    if output_format == "heatmap":
+        # The heatmap is always hourly so it takes a measure instead of a period
+        if period_input is not None:
+            return get_error_page("period cannot be used with format=heatmap, it is always hourly.")
+
+        measure = (measure or "temperature").lower()
+        if measure not in MEASURES:
+            return get_error_page(f"measure must be one of {', '.join(MEASURES)}.")
+    elif measure is not None:
+        return get_error_page("measure can only be used with format=heatmap, the other formats include every measure.")
 
     hash = hashlib.sha256(password.encode('utf-8')).hexdigest()
 
@@ -88,6 +264,19 @@ def handler(event, context):
     if from_time >= until_time:
         return get_error_page("'from' date must be earlier than 'until' date.")
 
+    device_id = location_table.get_device_id_by_location(location)
+
+    if not device_id:
+        return get_error_page(f"Device matching location not found.")
+    print("Found devide ID", device_id)
+
+    if output_format == "heatmap":
+        title = f"{location.capitalize()} {measure} from {from_input} until {until_input}"
+        return get_heatmap_response(device_id, location, from_time, until_time, measure, title)
+
+    if period_input is None:
+        return get_error_page("period must be provided.")
+
     reference = datetime(2000, 1, 1)  # Arbitrary fixed point
     parsed_period = dateparser.parse(period_input, settings={"RELATIVE_BASE": reference})
     
@@ -99,11 +288,8 @@ def handler(event, context):
     if period_seconds < 5 * 60:
         return get_error_page("Minimum period is 5 minutes.")
     
-    device_id = location_table.get_device_id_by_location(location)
-
-    if not device_id:
-        return get_error_page(f"Device matching location not found.")
-    print("Found devide ID", device_id)
+    if output_format != "html":
+        return get_data_response(device_id, from_time, until_time, period_seconds, output_format, if_none_match)
 
     data = measurements_helper.get_data_in_range(device_id, from_time, until_time)
 
@@ -1,8 +1,10 @@
 
 from datetime import date, datetime, time, timedelta
+import hashlib
+import json
 
 import numpy as np
-from dao.MeasurementsBucket import MeasurementsBucket
+from dao.MeasurementsBucket import MeasurementsBucket, day_key, month_key, year_key
 from dao.MeasurementsTable import MeasurementsTable
 
 # If the number of days we would need to download exceeds this value, download
@@ -10,6 +12,13 @@ from dao.MeasurementsTable import MeasurementsTable
 MAXIMUM_DAY_COUNT = 5
 MAXIMUM_MONTH_COUNT = 5
 
+# Columns of the [time, temperature, humidity] measurement arrays by name
+MEASURES = {"temperature": 1, "humidity": 2}
+
+MILLIS_PER_MINUTE = 60_000
+MILLIS_PER_HOUR = 60 * MILLIS_PER_MINUTE
+MILLIS_PER_DAY = 24 * MILLIS_PER_HOUR
+
 def filter_by_date_sorted(array: np.ndarray, start_date: datetime, end_date: datetime) -> np.ndarray:
     start_millis = start_date.timestamp() * 1000
     end_millis = end_date.timestamp() * 1000
@@ -20,6 +29,35 @@ def filter_by_date_sorted(array: np.ndarray, start_date: datetime, end_date: dat
     return array[start_idx:end_idx]
 
 
+def merge_sorted(existing: np.ndarray, new: np.ndarray) -> tuple[np.ndarray, bool]:
+    """
+    Merge new rows into an existing array sorted by time. Only the segment of
+    the existing array spanned by the new timestamps is touched, everything
+    before and after it is kept as is. Where both arrays have a row with the
+    same timestamp the new one wins. Returns the merged array and whether it
+    differs from the existing one.
+    """
+    if new.shape[0] == 0:
+        return existing, False
+    if existing.shape[0] == 0:
+        return new, True
+
+    start_idx = np.searchsorted(existing[:, 0], new[:, 0].min(), side='left')
+    end_idx = np.searchsorted(existing[:, 0], new[:, 0].max(), side='right')
+    overlap = existing[start_idx:end_idx]
+
+    # New rows go first so that np.unique, which keeps the first occurrence of
+    # each timestamp, prefers them over the existing ones
+    combined = np.concatenate([new, overlap], axis=0)
+    _, unique_idx = np.unique(combined[:, 0], return_index=True)
+    segment = combined[unique_idx]
+
+    if np.array_equal(segment, overlap):
+        return existing, False
+
+    return np.concatenate([existing[:start_idx], segment, existing[end_idx:]], axis=0), True
+
+
 def is_today(date: datetime):
     return date.date() == datetime.today().date()
 
@@ -29,6 +67,38 @@ def is_this_month(date: datetime):
     return date.year == today.year and date.month == today.month
 
 
+class _SourceRecorder:
+    """
+    Takes the place of both the bucket and the table to record which sources
+    MeasurementHelper would read for a range, without reading any of them.
+    """
+
+    def __init__(self):
+        self.keys: list[str] = []
+        self.reads_table = False
+
+    def download_day(self, device: str, date: date) -> np.ndarray:
+        self.keys.append(day_key(device, date))
+        return np.empty((0, 3))
+
+    def download_days_in_range(self, device: str, year: int, month: int, start_day: int, end_day: int) -> np.ndarray:
+        for day in range(start_day, end_day + 1):
+            self.download_day(device, date(year, month, day))
+        return np.empty((0, 3))
+
+    def download_month(self, device: str, date: date) -> np.ndarray:
+        self.keys.append(month_key(device, date))
+        return np.empty((0, 3))
+
+    def download_year(self, device: str, date: date) -> np.ndarray:
+        self.keys.append(year_key(device, date))
+        return np.empty((0, 3))
+
+    def get_sensor_data(self, device: str, start_time: datetime, end_time: datetime) -> np.ndarray:
+        self.reads_table = True
+        return np.empty((0, 3))
+
+
 class MeasurementHelper:
 
     def __init__(self, table: MeasurementsTable, bucket: MeasurementsBucket):
@@ -126,3 +196,24 @@ class MeasurementHelper:
         
         data = filter_by_date_sorted(data, start, end)
         return data
+
+
+    def get_version(self, device: str, start: datetime, end: datetime) -> str:
+        """
+        A fingerprint of the data get_data_in_range would return, built from the
+        ETags of the objects it would download and the time of the latest
+        measurement in the table if today is included. Much cheaper than
+        getting the data since nothing is downloaded.
+        """
+        recorder = _SourceRecorder()
+        MeasurementHelper(recorder, recorder).get_data_in_range(device, start, end)  # type: ignore
+
+        etags = self.bucket.get_etags(recorder.keys)
+        latest_time = self.table.get_latest_time(device) if recorder.reads_table else None
+
+        sources = {
+            "device": device,
+            "objects": list(zip(recorder.keys, etags)),
+            "latest_time": latest_time,
+        }
+        return hashlib.sha256(json.dumps(sources).encode("utf-8")).hexdigest()
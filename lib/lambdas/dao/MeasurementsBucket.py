@@ -1,7 +1,12 @@
 
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import date, datetime, timedelta
 import io
+import os
+import tempfile
 import boto3
+from botocore.exceptions import ClientError
 import numpy as np
 
 
@@ -17,12 +22,87 @@ def year_key(device: str, date: date):
     return f'{device}/{date.strftime("%Y")}/data.npy'
 
 
+def fleet_day_key(date: date):
+    return f'fleet/{date.strftime("%Y/%m/%d")}/data.npz'
+
+
+def fleet_month_key(date: date):
+    return f'fleet/{date.strftime("%Y/%m")}/data.npz'
+
+
+def fleet_rows(data_array: np.ndarray) -> int | None:
+    """
+    Number of rows a device's array contributes to a fleet object, or None if
+    it does not have the right shape to be included.
+    """
+    if data_array.size == 0:
+        return 0
+    if data_array.ndim != 2 or data_array.shape[1] != 3:
+        return None
+    return data_array.shape[0]
+
+
+def split_fleet(fleet: dict[str, np.ndarray]) -> dict[str, np.ndarray]:
+    """
+    Turn a fleet object back into per-device arrays in the usual
+    [time, temperature, humidity] row format.
+    """
+    rows = np.column_stack((fleet["time"], fleet["temperature"], fleet["humidity"]))
+    offsets = fleet["offsets"]
+    return {
+        str(device): rows[offsets[i]:offsets[i + 1]]
+        for i, device in enumerate(fleet["devices"])
+    }
+
+
+@dataclass
+class ArraySummary:
+    """
+    Enough about a stored array to tell whether it matches others without
+    comparing the arrays themselves. The checksums are a sum and a position
+    weighted sum of the integer timestamps modulo 2^64, which can be combined
+    for concatenated arrays without seeing their data.
+    """
+    rows: int
+    columns: int
+    first_time: float | None
+    last_time: float | None
+    time_sum: int | None = None
+    weighted_time_sum: int | None = None
+
+
+def summarise_array(data_array: np.ndarray, checksum: bool = False) -> ArraySummary:
+    rows = data_array.shape[0] if data_array.ndim > 0 else 0
+    columns = data_array.shape[1] if data_array.ndim == 2 else 0
+    if rows == 0 or columns == 0:
+        return ArraySummary(rows, columns, None, None, 0 if checksum else None, 0 if checksum else None)
+
+    summary = ArraySummary(rows, columns, float(data_array[0, 0]), float(data_array[-1, 0]))
+    if checksum:
+        # uint64 arithmetic wraps, giving the sums modulo 2^64
+        times = data_array[:, 0].astype(np.int64).view(np.uint64)
+        summary.time_sum = int(times.sum(dtype=np.uint64))
+        summary.weighted_time_sum = int((np.arange(rows, dtype=np.uint64) * times).sum(dtype=np.uint64))
+    return summary
+
+
+# Enough for the .npy header np.save writes, which is padded to 64 or 128 bytes,
+# and the first row after it
+SUMMARY_HEAD_BYTES = 256
+
 s3 = boto3.resource("s3")
+# Clients, unlike resources, are safe to share between threads
+s3_client = boto3.client("s3")
 
 class MeasurementsBucket:
 
-    def __init__(self, bucket_name: str):
-        self.bucket = s3.Bucket(bucket_name) # type: ignore
+    def __init__(self, bucket_name: str, s3_resource=None):
+        """
+        Pass s3_resource to use it instead of the shared module level one, for
+        example to give each thread its own since resources are not thread safe.
+        """
+        self.bucket_name = bucket_name
+        self.bucket = (s3_resource or s3).Bucket(bucket_name) # type: ignore
 
     def _download_file(self, s3_key: str) -> np.ndarray | None:
         try:
@@ -79,6 +159,87 @@ class MeasurementsBucket:
     def download_year(self, device: str, date: date) -> np.ndarray | None:
         return self._download_file(year_key(device, date))
     
+    def _get_etag(self, s3_key: str) -> str | None:
+        try:
+            return s3_client.head_object(Bucket=self.bucket_name, Key=s3_key)["ETag"]
+        except ClientError as e:
+            print(f'Failed to get ETag of {s3_key}: {e}')
+            return None
+
+    def _exists(self, s3_key: str) -> bool:
+        try:
+            s3_client.head_object(Bucket=self.bucket_name, Key=s3_key)
+            return True
+        except ClientError:
+            return False
+
+    def get_etags(self, s3_keys: list[str]) -> list[str | None]:
+        """
+        ETags of the given objects, in the same order, without downloading them.
+        Missing objects give None.
+        """
+        with ThreadPoolExecutor(max_workers=10) as executor:
+            return list(executor.map(self._get_etag, s3_keys))
+
+    def _read_object(self, s3_key: str, start: int | None = None, end: int | None = None) -> bytes:
+        if start is None:
+            return s3_client.get_object(Bucket=self.bucket_name, Key=s3_key)["Body"].read()
+        return s3_client.get_object(Bucket=self.bucket_name, Key=s3_key, Range=f"bytes={start}-{end}")["Body"].read()
+
+    def _summarise_file(self, s3_key: str, checksum: bool = False) -> ArraySummary | None:
+        """
+        Summarise a stored array. Without checksum only the header and the first
+        and last rows are downloaded using ranged requests, so the cost does not
+        depend on the size of the object.
+        """
+        try:
+            if checksum:
+                return summarise_array(np.load(io.BytesIO(self._read_object(s3_key))), checksum=True)
+
+            head = self._read_object(s3_key, 0, SUMMARY_HEAD_BYTES - 1)
+            stream = io.BytesIO(head)
+            version = np.lib.format.read_magic(stream)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(stream)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(stream)
+            data_offset = stream.tell()
+
+            rows = shape[0] if len(shape) > 0 else 0
+            columns = shape[1] if len(shape) == 2 else 0
+            if rows == 0 or columns == 0:
+                return ArraySummary(rows, columns, None, None)
+            if fortran_order:
+                # Rows are not contiguous so fall back to reading all of it
+                return summarise_array(np.load(io.BytesIO(self._read_object(s3_key))))
+
+            row_bytes = dtype.itemsize * columns
+            first_row = head[data_offset:data_offset + row_bytes]
+            if len(first_row) < row_bytes:
+                first_row = self._read_object(s3_key, data_offset, data_offset + row_bytes - 1)
+            last_row_offset = data_offset + (rows - 1) * row_bytes
+            last_row = self._read_object(s3_key, last_row_offset, last_row_offset + row_bytes - 1)
+
+            first_time = float(np.frombuffer(first_row, dtype=dtype)[0])
+            last_time = float(np.frombuffer(last_row, dtype=dtype)[0])
+            return ArraySummary(rows, columns, first_time, last_time)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") not in ("NoSuchKey", "404"):
+                print(f'Failed to summarise {s3_key}: {e}')
+            return None
+        except Exception as e:
+            print(f'Failed to summarise {s3_key}: {e}')
+            return None
+
+    def summarise_day(self, device: str, date: date, checksum: bool = False) -> ArraySummary | None:
+        return self._summarise_file(day_key(device, date), checksum)
+
+    def summarise_month(self, device: str, date: date, checksum: bool = False) -> ArraySummary | None:
+        return self._summarise_file(month_key(device, date), checksum)
+
+    def summarise_year(self, device: str, date: date, checksum: bool = False) -> ArraySummary | None:
+        return self._summarise_file(year_key(device, date), checksum)
+
     def _upload_file(self, s3_key: str, data_array):
         try:
             file_stream = io.BytesIO()
@@ -98,3 +259,100 @@ class MeasurementsBucket:
 
     def upload_year(self, device: str, date: date, data_array: np.ndarray):
         self._upload_file(year_key(device, date), data_array)
+
+    def _write_fleet_file(self, s3_key: str, row_counts: dict[str, int], fill_device):
+        """
+        Store every device's series for a period in one object so that fleet-wide
+        queries need a single download. Each column is stored contiguously and
+        device i owns rows offsets[i] to offsets[i + 1].
+
+        The columns are allocated once from the row counts and fill_device(device)
+        is called for one device at a time to get its rows, so the only full
+        copy of the fleet's data in memory is the columns themselves.
+        """
+        if not row_counts:
+            print(f"No data to upload to {s3_key}")
+            return
+
+        devices = list(row_counts)
+        offsets = np.zeros(len(devices) + 1, dtype=np.int64)
+        np.cumsum([row_counts[device] for device in devices], out=offsets[1:])
+        # One row per column so that each column is contiguous
+        columns = np.empty((3, offsets[-1]))
+
+        for i, device in enumerate(devices):
+            if offsets[i + 1] == offsets[i]:
+                continue
+            data_array = fill_device(device)
+            if data_array is None or data_array.shape != (offsets[i + 1] - offsets[i], 3):
+                print(f"Not uploading {s3_key} since the data for {device} changed while building it")
+                return
+            columns[:, offsets[i]:offsets[i + 1]] = data_array.T
+
+        try:
+            # Writing to a file lets np.savez stream the columns out rather than
+            # building another copy of them in memory
+            with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, "data.npz")
+                np.savez(
+                    path,
+                    devices=np.array(devices),
+                    offsets=offsets,
+                    time=columns[0],
+                    temperature=columns[1],
+                    humidity=columns[2]
+                )
+                self.bucket.upload_file(path, s3_key)
+            print(f"Uploaded {s3_key} containing {len(devices)} devices and {offsets[-1]} rows")
+        except Exception as e:
+            print(f'Failed to upload {s3_key}: {e}')
+
+    def _download_fleet_file(self, s3_key: str) -> dict[str, np.ndarray] | None:
+        try:
+            file_stream = io.BytesIO()
+            self.bucket.download_fileobj(s3_key, file_stream)
+            file_stream.seek(0)
+            with np.load(file_stream) as npz:
+                fleet = {name: npz[name] for name in npz.files}
+            print(f"Downloaded {s3_key} containing {len(fleet['devices'])} devices and {fleet['time'].shape[0]} rows")
+            return fleet
+        except Exception as e:
+            print(f'Failed to download or load {s3_key}: {e}')
+            return None
+
+    def upload_fleet_day(self, date: date, device_arrays: dict[str, np.ndarray]):
+        row_counts = {}
+        for device, data_array in device_arrays.items():
+            rows = fleet_rows(data_array)
+            if rows is None:
+                print(f"Leaving {device} out of the fleet day since its shape is {data_array.shape}")
+            else:
+                row_counts[device] = rows
+
+        self._write_fleet_file(fleet_day_key(date), row_counts, device_arrays.get)
+
+    def upload_fleet_month(self, date: date, devices: list[str], row_counts: dict[str, int] | None = None):
+        """
+        Build the fleet month from the devices' month objects, downloading them
+        one at a time. Pass the row count of each device's month if known,
+        otherwise they are downloaded twice: once to count and once to copy.
+        """
+        if row_counts is None:
+            row_counts = {}
+            for device in devices:
+                month_array = self.download_month(device, date)
+                rows = fleet_rows(month_array) if month_array is not None else None
+                # Empty months are left out, as they are by the monthly aggregation
+                if rows:
+                    row_counts[device] = rows
+
+        self._write_fleet_file(fleet_month_key(date), row_counts, lambda device: self.download_month(device, date))
+
+    def fleet_month_exists(self, date: date) -> bool:
+        return self._exists(fleet_month_key(date))
+
+    def download_fleet_day(self, date: date) -> dict[str, np.ndarray] | None:
+        return self._download_fleet_file(fleet_day_key(date))
+
+    def download_fleet_month(self, date: date) -> dict[str, np.ndarray] | None:
+        return self._download_fleet_file(fleet_month_key(date))
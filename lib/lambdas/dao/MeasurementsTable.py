@@ -29,4 +29,19 @@ class MeasurementsTable:
             for item in items
         ], dtype=np.float64)
 
-        return data
\ No newline at end of file
+        return data
+
+    def get_latest_time(self, device: str) -> int | None:
+        response = self.table.query(
+            KeyConditionExpression=Key("device_id").eq(device),
+            ProjectionExpression="#time",
+            ExpressionAttributeNames={"#time": "time"},
+            ScanIndexForward=False,
+            Limit=1
+        )
+
+        items = response.get("Items", [])
+        if not items:
+            return None
+
+        return int(items[0]["time"])
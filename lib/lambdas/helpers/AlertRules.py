@@ -0,0 +1,201 @@
+
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from datetime import datetime, timezone
+import json
+
+import numpy as np
+from dao.MeasurementHelper import MEASURES, MILLIS_PER_HOUR, MILLIS_PER_MINUTE
+
+
+@dataclass
+class Finding:
+    device: str
+    rule: str
+    start: float
+    end: float
+    detail: str
+
+    def __str__(self):
+        return f"{self.device}: {self.rule} from {format_time(self.start)} to {format_time(self.end)}, {self.detail}"
+
+
+def format_time(millis: float) -> str:
+    return datetime.fromtimestamp(millis / 1000, timezone.utc).strftime("%Y-%m-%d %H:%M UTC")
+
+
+def find_runs(mask: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    First and last indices of each run of consecutive True values in mask.
+    """
+    edges = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1) - 1
+
+
+class Rule(ABC):
+    """
+    A check run over one device's measurements for a day. Arrays are sorted by
+    time with rows of [time, temperature, humidity] and may be empty.
+    """
+
+    name = "rule"
+
+    @abstractmethod
+    def evaluate(self, device: str, array: np.ndarray, start: float, end: float) -> list[Finding]:
+        pass
+
+
+class ThresholdRule(Rule):
+    """Measure stays above or below a limit for at least min_minutes."""
+
+    def __init__(self, measure: str, limit: float, above: bool = True, min_minutes: float = 0):
+        self.measure = measure
+        self.limit = limit
+        self.above = above
+        self.min_minutes = min_minutes
+        self.name = f"{measure} {'above' if above else 'below'} {limit}"
+
+    def evaluate(self, device, array, start, end):
+        times = array[:, 0]
+        values = array[:, MEASURES[self.measure]]
+        mask = values > self.limit if self.above else values < self.limit
+
+        findings = []
+        for first, last in zip(*find_runs(mask)):
+            if times[last] - times[first] < self.min_minutes * MILLIS_PER_MINUTE:
+                continue
+            run = values[first:last + 1]
+            extreme = run.max() if self.above else run.min()
+            findings.append(Finding(device, self.name, float(times[first]), float(times[last]), f"reaching {extreme:.1f}"))
+        return findings
+
+
+class RateOfChangeRule(Rule):
+    """Measure changes faster than max_change_per_hour between two readings."""
+
+    def __init__(self, measure: str, max_change_per_hour: float):
+        self.measure = measure
+        self.max_change_per_hour = max_change_per_hour
+        self.name = f"{measure} changing faster than {max_change_per_hour}/h"
+
+    def evaluate(self, device, array, start, end):
+        times = array[:, 0]
+        values = array[:, MEASURES[self.measure]]
+        if times.size < 2:
+            return []
+
+        hours = np.diff(times) / MILLIS_PER_HOUR
+        with np.errstate(divide="ignore", invalid="ignore"):
+            rates = np.diff(values) / hours
+        mask = np.abs(np.where(hours > 0, rates, 0)) > self.max_change_per_hour
+
+        findings = []
+        for first, last in zip(*find_runs(mask)):
+            steepest = first + np.argmax(np.abs(rates[first:last + 1]))
+            findings.append(Finding(device, self.name, float(times[first]), float(times[last + 1]), f"up to {rates[steepest]:+.1f}/h"))
+        return findings
+
+
+class StuckSensorRule(Rule):
+    """Measure reports exactly the same value for at least min_minutes."""
+
+    def __init__(self, measure: str, min_minutes: float):
+        self.measure = measure
+        self.min_minutes = min_minutes
+        self.name = f"{measure} stuck"
+
+    def evaluate(self, device, array, start, end):
+        times = array[:, 0]
+        values = array[:, MEASURES[self.measure]]
+        mask = np.diff(values) == 0
+
+        findings = []
+        for first, last in zip(*find_runs(mask)):
+            # Run of equal differences covers readings first to last + 1
+            if times[last + 1] - times[first] >= self.min_minutes * MILLIS_PER_MINUTE:
+                findings.append(Finding(device, self.name, float(times[first]), float(times[last + 1]), f"at {values[first]:.1f}"))
+        return findings
+
+
+class MissingDataRule(Rule):
+    """No readings for more than max_gap_minutes, including at either end of the day."""
+
+    def __init__(self, max_gap_minutes: float):
+        self.max_gap_minutes = max_gap_minutes
+        self.name = "missing data"
+
+    def evaluate(self, device, array, start, end):
+        times = np.concatenate(([start], array[:, 0], [end]))
+        gaps = np.diff(times)
+        gap_idx = np.flatnonzero(gaps > self.max_gap_minutes * MILLIS_PER_MINUTE)
+
+        return [
+            Finding(device, self.name, float(times[i]), float(times[i + 1]), f"{gaps[i] / MILLIS_PER_MINUTE:.0f} minutes without readings")
+            for i in gap_idx
+        ]
+
+
+# Rules used when ALERT_RULES is not set in the environment
+DEFAULT_RULES: list[Rule] = [
+    ThresholdRule("temperature", 28, above=True, min_minutes=60),
+    ThresholdRule("temperature", 10, above=False, min_minutes=60),
+    ThresholdRule("humidity", 75, above=True, min_minutes=120),
+    RateOfChangeRule("temperature", 10),
+    StuckSensorRule("temperature", 180),
+    MissingDataRule(30),
+]
+
+RULE_TYPES: dict[str, type[Rule]] = {
+    "threshold": ThresholdRule,
+    "rate_of_change": RateOfChangeRule,
+    "stuck": StuckSensorRule,
+    "missing_data": MissingDataRule,
+}
+
+
+def rules_from_config(config: str | None) -> list[Rule]:
+    """
+    Rules from a JSON list of objects, each with a type from RULE_TYPES and the
+    arguments for that rule, for example
+    [{"type": "threshold", "measure": "temperature", "limit": 30, "min_minutes": 60}].
+    This is how AggregateMeasurementData reads the ALERT_RULES environment
+    variable, so the rules can be changed without changing the code. Without a
+    config the defaults are used.
+    """
+    if config is None:
+        return DEFAULT_RULES
+
+    rules = []
+    for rule_config in json.loads(config):
+        arguments = dict(rule_config)
+        rule_type = arguments.pop("type", None)
+        if rule_type not in RULE_TYPES:
+            raise ValueError(f"Alert rule type must be one of {', '.join(RULE_TYPES)}, not {rule_type}")
+        if arguments.get("measure", "temperature") not in MEASURES:
+            raise ValueError(f"Alert rule measure must be one of {', '.join(MEASURES)}, not {arguments['measure']}")
+        try:
+            rules.append(RULE_TYPES[rule_type](**arguments))
+        except TypeError as e:
+            raise ValueError(f"Invalid arguments for {rule_type} alert rule: {e}")
+    return rules
+
+
+def evaluate_rules(device: str, array: np.ndarray, start: datetime, end: datetime,
+                   rules: list[Rule] = DEFAULT_RULES) -> list[Finding]:
+    """
+    Run every rule over a device's data for the period from start to end. A rule
+    that fails is reported and skipped so that it cannot stop the aggregation.
+    """
+    if array.size == 0:
+        array = np.empty((0, 3))
+
+    start_millis = start.timestamp() * 1000
+    end_millis = end.timestamp() * 1000
+
+    findings = []
+    for rule in rules:
+        try:
+            findings.extend(rule.evaluate(device, array, start_millis, end_millis))
+        except Exception as e:
+            print(f"Failed to evaluate {rule.name} for {device}: {e}")
+    return findings
@@ -0,0 +1,461 @@
+"""
+Local load generator and throughput benchmark for the measurement pipeline.
+
+Synthesizes temperature/humidity readings for many devices, writes them into
+in-memory stand-ins for the DynamoDB measurements table and the S3 measurement
+bucket, then drives the daily, monthly and yearly aggregation in
+AggregateMeasurementData exactly as the scheduled rules would. Alerts go to an
+in-memory stand-in for the SNS topic. Nothing touches AWS, so it can be run
+anywhere the lambda requirements are installed.
+
+Example:
+    python scripts/benchmark_ingest.py --devices 2000 --days 31 --interval 300
+"""
+import argparse
+import bisect
+import contextlib
+import io
+import math
+import os
+import resource
+import sys
+import time
+import tracemalloc
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+import numpy as np
+from botocore.exceptions import ClientError
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib', 'lambdas'))
+
+# The lambda modules read these at import time and create boto3 resources, which
+# need a region even though no request is ever sent.
+os.environ.setdefault('AWS_DEFAULT_REGION', 'eu-west-2')
+os.environ.setdefault('LOCATION_TABLE_NAME', 'BenchmarkLocations')
+os.environ.setdefault('MEASUREMENTS_TABLE_NAME', 'BenchmarkMeasurements')
+os.environ.setdefault('BUCKET_NAME', 'benchmark-measurement-data')
+
+import AggregateMeasurementData  # noqa: E402
+import dao.MeasurementsBucket  # noqa: E402
+
+# DynamoDB stops a query page at 1 MB of data and MeasurementsTable does not
+# follow LastEvaluatedKey, so anything beyond that is silently lost.
+DYNAMODB_PAGE_LIMIT_BYTES = 1024 * 1024
+
+
+class InMemoryMeasurementsTable:
+    """Stand-in for the boto3 Table behind MeasurementsTable."""
+
+    def __init__(self):
+        self.items: dict[str, dict[int, dict]] = {}
+        self.sorted_times: dict[str, list[int]] = {}
+        self.truncated_queries = 0
+        # Called with the device of every query so that time can be attributed to it
+        self.on_access = None
+
+    def put_item(self, Item: dict):
+        device_items = self.items.setdefault(Item['device_id'], {})
+        item_time = int(Item['time'])
+        if item_time not in device_items:
+            self.sorted_times.pop(Item['device_id'], None)
+        device_items[item_time] = Item
+
+    def query(self, KeyConditionExpression, **kwargs):
+        device, start, end = parse_key_condition(KeyConditionExpression)
+        if self.on_access:
+            self.on_access(device)
+        device_items = self.items.get(device, {})
+
+        times = self.sorted_times.get(device)
+        if times is None:
+            times = sorted(device_items)
+            self.sorted_times[device] = times
+
+        start_idx = bisect.bisect_left(times, start)
+        end_idx = bisect.bisect_right(times, end)
+
+        page = []
+        page_size = 0
+        for item_time in times[start_idx:end_idx]:
+            item = device_items[item_time]
+            page_size += item_size(item)
+            if page_size > DYNAMODB_PAGE_LIMIT_BYTES:
+                self.truncated_queries += 1
+                return {'Items': page, 'LastEvaluatedKey': {'device_id': device, 'time': item['time']}}
+            page.append(item)
+
+        return {'Items': page}
+
+
+class InMemoryLocationTable:
+    """Stand-in for the boto3 Table behind LocationTable."""
+
+    def __init__(self, devices: list[str]):
+        self.devices = devices
+
+    def scan(self, **kwargs):
+        return {'Items': [{'device_id': device, 'location': device} for device in self.devices]}
+
+
+class InMemoryTopic:
+    """Stand-in for the SNS client that AggregateMeasurementData publishes alerts with."""
+
+    def __init__(self):
+        self.messages: list[dict] = []
+
+    def publish(self, **kwargs):
+        self.messages.append(kwargs)
+
+
+class InMemoryBucket:
+    """Stand-in for the boto3 Bucket behind MeasurementsBucket."""
+
+    def __init__(self):
+        self.objects: dict[str, bytes] = {}
+        # Called with the device, or 'fleet', of every object accessed
+        self.on_access = None
+
+    def _access(self, key: str):
+        if self.on_access:
+            self.on_access(key_owner(key))
+
+    def download_fileobj(self, key: str, file_stream):
+        self._access(key)
+        if key not in self.objects:
+            raise KeyError(f'NoSuchKey: {key}')
+        file_stream.write(self.objects[key])
+
+    def upload_fileobj(self, file_stream, key: str):
+        self._access(key)
+        self.objects[key] = file_stream.read()
+
+    def upload_file(self, path: str, key: str):
+        with open(path, 'rb') as file_stream:
+            self.upload_fileobj(file_stream, key)
+
+    # MeasurementsBucket makes some requests with the S3 client instead
+    def head_object(self, Bucket: str, Key: str):
+        self._access(Key)
+        if Key not in self.objects:
+            raise ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+        return {'ETag': f'"{hash(self.objects[Key]):x}"', 'ContentLength': len(self.objects[Key])}
+
+    def get_object(self, Bucket: str, Key: str, Range: str | None = None):
+        self._access(Key)
+        if Key not in self.objects:
+            raise ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+        body = self.objects[Key]
+        if Range is not None:
+            start, end = Range.removeprefix('bytes=').split('-')
+            body = body[int(start):int(end) + 1]
+        return {'Body': io.BytesIO(body)}
+
+
+def split_key(key: str) -> tuple[str, int]:
+    """
+    Owner and number of date parts of a key. Keys are {device}/{Y}[/{m}[/{d}]]/data.npy
+    or fleet/{Y}/{m}[/{d}]/data.npz, and device ids may contain '/'.
+    """
+    parts = key.split('/')[:-1]
+    date_parts = 0
+    while date_parts < len(parts) and parts[-1 - date_parts].isdigit():
+        date_parts += 1
+    return '/'.join(parts[:len(parts) - date_parts]), date_parts
+
+
+def key_owner(key: str) -> str:
+    return split_key(key)[0]
+
+
+def parse_key_condition(condition) -> tuple[str, float, float]:
+    """
+    Pull the device id and time range out of the boto3 condition built by
+    MeasurementsTable.get_sensor_data.
+    """
+    device = None
+    start, end = -math.inf, math.inf
+
+    for part in condition.get_expression()['values']:
+        expression = part.get_expression()
+        operator = expression['operator']
+        values = expression['values']
+        if operator == '=' and values[0].name == 'device_id':
+            device = values[1]
+        elif operator == 'BETWEEN' and values[0].name == 'time':
+            start, end = int(values[1]), int(values[2])
+        else:
+            raise ValueError(f'Unsupported key condition {expression}')
+
+    if device is None:
+        raise ValueError('Query must specify a device_id')
+    return device, start, end
+
+
+def item_size(item: dict) -> int:
+    # Same approximation DynamoDB uses: attribute name length plus value length
+    return sum(len(name) + len(str(value)) for name, value in item.items())
+
+
+def synthesize_readings(device_index: int, start_millis: int, count: int, interval_millis: int,
+                        rng: np.random.Generator) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Readings for one device: a per-device baseline with a daily cycle, a slow
+    random walk and sensor noise, with occasional dropped messages.
+    """
+    times = start_millis + np.arange(count, dtype=np.int64) * interval_millis
+    times += rng.integers(0, 2000, count)  # IoT rule timestamps are not perfectly regular
+
+    hours = (times / 3_600_000) % 24
+    daily_cycle = np.sin((hours - 9) / 24 * 2 * np.pi)
+
+    baseline_temperature = 17 + (device_index % 9)
+    temperature = (baseline_temperature + 2.5 * daily_cycle
+                   + np.cumsum(rng.normal(0, 0.02, count)) + rng.normal(0, 0.1, count))
+    humidity = np.clip(55 - 8 * daily_cycle + np.cumsum(rng.normal(0, 0.05, count))
+                       + rng.normal(0, 0.5, count), 0, 100)
+
+    kept = rng.random(count) > 0.002
+    return times[kept], temperature[kept].round(2), humidity[kept].round(2)
+
+
+def ingest(table: InMemoryMeasurementsTable, devices: list[str], start: datetime, days: int,
+           interval_seconds: int, seed: int) -> int:
+    """
+    Write every synthesized reading through put_item the way StoreMeasurement
+    does. Returns the number of items.
+    """
+    rng = np.random.default_rng(seed)
+    start_millis = int(start.timestamp() * 1000)
+    interval_millis = interval_seconds * 1000
+    count = days * 86400 // interval_seconds
+
+    total_items = 0
+    for device_index, device in enumerate(devices):
+        times, temperatures, humidities = synthesize_readings(device_index, start_millis, count, interval_millis, rng)
+        for item_time, temperature, humidity in zip(times.tolist(), temperatures.tolist(), humidities.tolist()):
+            table.put_item(Item={
+                'device_id': device,
+                'time': Decimal(item_time),
+                'temperature': Decimal(str(temperature)),
+                'humidity': Decimal(str(humidity)),
+            })
+        total_items += len(times)
+
+    return total_items
+
+
+def month_starts(start: date, days: int) -> list[date]:
+    months = []
+    for offset in range(days):
+        day = start + timedelta(days=offset)
+        first = date(day.year, day.month, 1)
+        if first not in months:
+            months.append(first)
+    return months
+
+
+class Phase:
+    """
+    Collects timings and the memory high-water mark for one stage.
+
+    Each run covers the whole fleet, as the scheduled invocations do. The time
+    inside a run is split between devices by following which device the
+    in-memory table and bucket are being asked about, while writing the fleet
+    objects is timed separately.
+    """
+
+    def __init__(self, name: str, trace_memory: bool, stand_ins: tuple = (), measurements_bucket=None):
+        self.name = name
+        self.trace_memory = trace_memory
+        self.stand_ins = stand_ins
+        self.measurements_bucket = measurements_bucket
+        self.run_durations: list[float] = []
+        self.device_durations: list[float] = []
+        self.fleet_durations: list[float] = []
+        self.other_durations: list[float] = []
+        self.elapsed = 0.0
+        self.traced_start = 0
+        self.traced_peak = 0
+
+    def __enter__(self):
+        for stand_in in self.stand_ins:
+            stand_in.on_access = self.mark
+        if self.measurements_bucket is not None:
+            for method in ('upload_fleet_day', 'upload_fleet_month'):
+                setattr(self.measurements_bucket, method, self.fleet_write(getattr(self.measurements_bucket, method)))
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            self.traced_start = tracemalloc.get_traced_memory()[0]
+        self.began = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.began
+        if self.trace_memory:
+            self.traced_peak = tracemalloc.get_traced_memory()[1]
+        for stand_in in self.stand_ins:
+            stand_in.on_access = None
+        if self.measurements_bucket is not None:
+            for method in ('upload_fleet_day', 'upload_fleet_month'):
+                delattr(self.measurements_bucket, method)
+
+    def mark(self, owner: str):
+        if self.in_fleet_write or owner == self.owner:
+            return
+        self.close_span()
+        self.owner = owner
+
+    def close_span(self):
+        now = time.perf_counter()
+        self.owner_times[self.owner] = self.owner_times.get(self.owner, 0.0) + now - self.span_began
+        self.span_began = now
+
+    def fleet_write(self, method):
+        def timed(*args, **kwargs):
+            self.close_span()
+            self.in_fleet_write = True
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.in_fleet_write = False
+                self.owner = 'fleet'
+                self.close_span()
+                self.owner = None
+        return timed
+
+    def time_run(self, function, *args):
+        # Time not spent on any device or fleet object, such as sending alerts,
+        # is owned by None
+        self.owner = None
+        self.owner_times: dict[str | None, float] = {}
+        self.in_fleet_write = False
+        began = time.perf_counter()
+        self.span_began = began
+        function(*args)
+        self.close_span()
+        self.run_durations.append(time.perf_counter() - began)
+
+        self.fleet_durations.append(self.owner_times.pop('fleet', 0.0))
+        self.other_durations.append(self.owner_times.pop(None, 0.0))
+        self.device_durations.extend(self.owner_times.values())
+
+    def report(self):
+        print(f'{self.name}:')
+        print(f'  wall time               {self.elapsed:10.2f} s')
+        if self.run_durations:
+            print(f'  runs                    {len(self.run_durations):10d}')
+            print(f'  per run mean            {np.mean(self.run_durations):10.2f} s')
+        if self.device_durations:
+            durations = np.array(self.device_durations) * 1000
+            print(f'  per device mean         {durations.mean():10.2f} ms')
+            print(f'  per device p95          {np.percentile(durations, 95):10.2f} ms')
+            print(f'  per device max          {durations.max():10.2f} ms')
+        if any(self.fleet_durations):
+            print(f'  fleet objects per run   {np.mean(self.fleet_durations) * 1000:10.2f} ms')
+        if self.run_durations:
+            print(f'  other per run           {np.mean(self.other_durations) * 1000:10.2f} ms')
+        if self.trace_memory:
+            print(f'  traced memory peak      {self.traced_peak / 2**20:10.1f} MiB '
+                  f'({(self.traced_peak - self.traced_start) / 2**20:.1f} MiB above the start of the phase)')
+        print(f'  process RSS high-water  {max_rss_mib():10.1f} MiB')
+
+
+def max_rss_mib() -> float:
+    # ru_maxrss is KiB on Linux and bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / (2**20 if sys.platform == 'darwin' else 2**10)
+
+
+def report_object_sizes(bucket: InMemoryBucket):
+    levels = {'day': [], 'month': [], 'year': [], 'fleet day': [], 'fleet month': []}
+    for key, body in bucket.objects.items():
+        level = {1: 'year', 2: 'month', 3: 'day'}.get(split_key(key)[1])
+        if level and key.endswith('.npz'):
+            level = f'fleet {level}'
+        if level in levels:
+            levels[level].append(len(body))
+
+    print('Object sizes:')
+    for level, sizes in levels.items():
+        if sizes:
+            sizes_array = np.array(sizes) / 1024
+            print(f'  {level:<11} count {len(sizes):7d}  mean {sizes_array.mean():9.1f} KiB  '
+                  f'max {sizes_array.max():9.1f} KiB  total {sizes_array.sum() / 1024:9.1f} MiB')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--devices', type=int, default=1000, help='Number of simulated devices')
+    parser.add_argument('--days', type=int, default=31, help='Number of days of readings to generate')
+    parser.add_argument('--interval', type=int, default=300, help='Seconds between readings from each device')
+    parser.add_argument('--start', default='2024-01-01', help='First day of generated data (YYYY-MM-DD)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--skip-monthly', action='store_true', help='Only run the daily aggregation')
+    parser.add_argument('--skip-yearly', action='store_true', help='Do not run the yearly aggregation')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='Also report tracemalloc peaks per phase (slows everything down)')
+    parser.add_argument('--verbose', action='store_true', help='Show the output of the aggregation code')
+    args = parser.parse_args()
+
+    start = datetime.strptime(args.start, '%Y-%m-%d')
+    devices = [f'picotherm/bench-{i:05d}' for i in range(args.devices)]
+
+    table = InMemoryMeasurementsTable()
+    bucket = InMemoryBucket()
+    AggregateMeasurementData.measurements_table.table = table
+    AggregateMeasurementData.measurements_bucket.bucket = bucket
+    dao.MeasurementsBucket.s3_client = bucket
+    AggregateMeasurementData.location_table.table = InMemoryLocationTable(devices)
+    # Publish alerts whether or not ALERT_TOPIC_ARN is set in the environment so
+    # that the notification is part of every run
+    topic = InMemoryTopic()
+    AggregateMeasurementData.sns = topic
+    AggregateMeasurementData.alert_topic_arn = 'arn:aws:sns:eu-west-2:000000000000:benchmark-alerts'
+
+    if args.trace_memory:
+        tracemalloc.start()
+
+    print(f'Generating {args.days} days for {args.devices} devices every {args.interval}s')
+    with Phase('Ingest', args.trace_memory) as ingest_phase:
+        total_items = ingest(table, devices, start, args.days, args.interval, args.seed)
+    ingest_phase.report()
+    print(f'  items written           {total_items:10d}')
+
+    # The aggregation code prints for every object it touches
+    quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(open(os.devnull, 'w'))
+
+    stand_ins = (table, bucket)
+    measurements_bucket = AggregateMeasurementData.measurements_bucket
+
+    with Phase('Daily aggregation', args.trace_memory, stand_ins, measurements_bucket) as daily, quiet:
+        for offset in range(args.days):
+            daily.time_run(AggregateMeasurementData.process_daily, devices, start + timedelta(days=offset))
+    daily.report()
+    print(f'  days processed          {args.days * args.devices / daily.elapsed:10.0f} device-days/s')
+    print(f'  items aggregated        {total_items / daily.elapsed:10.0f} items/s')
+    print(f'  alerts published        {len(topic.messages):10d}')
+
+    if not args.skip_monthly:
+        months = month_starts(start.date(), args.days)
+        with Phase('Monthly aggregation', args.trace_memory, stand_ins, measurements_bucket) as monthly, quiet:
+            for month in months:
+                monthly.time_run(AggregateMeasurementData.process_monthly, devices, datetime(month.year, month.month, 1))
+        monthly.report()
+
+        if not args.skip_yearly:
+            years = sorted({month.year for month in months})
+            with Phase('Yearly aggregation', args.trace_memory, stand_ins, measurements_bucket) as yearly, quiet:
+                for year in years:
+                    yearly.time_run(AggregateMeasurementData.process_yearly, devices, datetime(year, 1, 1))
+            yearly.report()
+
+    report_object_sizes(bucket)
+
+    if table.truncated_queries:
+        print(f'WARNING: {table.truncated_queries} table queries exceeded the {DYNAMODB_PAGE_LIMIT_BYTES // 1024} KiB '
+              'DynamoDB page limit and would lose data because get_sensor_data does not paginate')
+
+
+if __name__ == '__main__':
+    main()
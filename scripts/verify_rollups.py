@@ -0,0 +1,264 @@
+"""
+Check that month and year objects in the measurement bucket match the day and
+month objects they are built from, and optionally rebuild the ones that do not.
+
+Each rollup is compared with the concatenation of its sources, skipping the
+same empty or misshapen sources that download_days_in_range and
+download_months_in_range skip. By default only row counts and first and last
+timestamps are compared, which needs a couple of small ranged reads per
+object. --checksum also compares checksums of the time column, which means
+downloading everything. Fleet month objects are rebuilt after their device
+months are repaired when the whole fleet is known from --location-table.
+Rebuilt rollups are checked again, and the exit status is non-zero if anything
+still does not match.
+
+Example:
+    python scripts/verify_rollups.py --from 2024-01 --until 2024-12 --devices picotherm/kitchen --repair
+"""
+import argparse
+import calendar
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+import boto3
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib', 'lambdas'))
+
+from dao.LocationTable import LocationTable  # noqa: E402
+from dao.MeasurementsBucket import ArraySummary, MeasurementsBucket  # noqa: E402
+
+BUCKET_NAME = 'picotherm-measurement-data'
+CHECKSUM_MODULUS = 2**64
+
+thread_local = threading.local()
+
+
+def get_bucket(bucket_name: str) -> MeasurementsBucket:
+    # boto3 resources are not thread safe so each worker gets its own
+    if not hasattr(thread_local, 'bucket'):
+        thread_local.bucket = MeasurementsBucket(bucket_name, boto3.Session().resource('s3'))
+    return thread_local.bucket
+
+
+def concatenate_summaries(summaries: list[ArraySummary]) -> ArraySummary | None:
+    """
+    Summary of the concatenation of the summarised arrays, in order.
+    """
+    if not summaries:
+        return None
+
+    rows = 0
+    time_sum = 0
+    weighted_time_sum = 0
+    for summary in summaries:
+        if summary.time_sum is not None and summary.weighted_time_sum is not None:
+            # Positions in this part are shifted by the rows that come before it
+            weighted_time_sum = (weighted_time_sum + summary.weighted_time_sum + rows * summary.time_sum) % CHECKSUM_MODULUS
+            time_sum = (time_sum + summary.time_sum) % CHECKSUM_MODULUS
+        rows += summary.rows
+
+    combined = ArraySummary(rows, 3, summaries[0].first_time, summaries[-1].last_time)
+    # Checksums are only known when every part has them
+    if all(summary.time_sum is not None for summary in summaries):
+        combined.time_sum = time_sum
+        combined.weighted_time_sum = weighted_time_sum
+    return combined
+
+
+def compare_summaries(expected: ArraySummary | None, actual: ArraySummary | None) -> list[str]:
+    if actual is None:
+        return [] if expected is None else ['rollup is missing']
+    if expected is None:
+        return [f'rollup has {actual.rows} rows but none of its sources have data'] if actual.rows else []
+
+    problems = []
+    if actual.columns != 3:
+        problems.append(f'rollup has {actual.columns} columns')
+    if actual.rows != expected.rows:
+        problems.append(f'rollup has {actual.rows} rows but sources have {expected.rows}')
+    if actual.first_time != expected.first_time:
+        problems.append(f'rollup starts at {actual.first_time} but sources start at {expected.first_time}')
+    if actual.last_time != expected.last_time:
+        problems.append(f'rollup ends at {actual.last_time} but sources end at {expected.last_time}')
+    if expected.time_sum is not None and actual.time_sum is not None and (
+            actual.time_sum != expected.time_sum or actual.weighted_time_sum != expected.weighted_time_sum):
+        problems.append('time column checksum differs')
+    return problems
+
+
+def usable_sources(summaries: list[tuple[date, ArraySummary | None]], notes: list[str]) -> list[ArraySummary]:
+    """
+    Sources that the rollup is built from, noting the ones that are left out.
+    """
+    usable = []
+    for source_date, summary in summaries:
+        if summary is None:
+            continue
+        if summary.rows != 0 and summary.columns == 3:
+            usable.append(summary)
+        else:
+            notes.append(f'{source_date} is left out of the rollup since its shape is ({summary.rows}, {summary.columns})')
+    return usable
+
+
+def last_day_in_rollup(year: int, month: int, today: date) -> int:
+    # The current month's rollup only contains days up to yesterday
+    if (year, month) == (today.year, today.month):
+        return (today - timedelta(days=1)).day if today.day > 1 else 0
+    return calendar.monthrange(year, month)[1]
+
+
+def last_month_in_rollup(year: int, today: date) -> int:
+    # The current year's rollup only contains months before this one
+    return today.month - 1 if year == today.year else 12
+
+
+class Verifier:
+
+    def __init__(self, bucket_name: str, checksum: bool, today: date):
+        self.bucket_name = bucket_name
+        self.checksum = checksum
+        self.today = today
+
+    def verify_month(self, device: str, year: int, month: int) -> tuple[list[str], list[str]]:
+        bucket = get_bucket(self.bucket_name)
+        days = [date(year, month, day) for day in range(1, last_day_in_rollup(year, month, self.today) + 1)]
+
+        notes = []
+        day_summaries = [(day, bucket.summarise_day(device, day, self.checksum)) for day in days]
+        expected = concatenate_summaries(usable_sources(day_summaries, notes))
+        actual = bucket.summarise_month(device, date(year, month, 1), self.checksum)
+        return compare_summaries(expected, actual), notes
+
+    def verify_year(self, device: str, year: int) -> tuple[list[str], list[str]]:
+        bucket = get_bucket(self.bucket_name)
+        months = [date(year, month, 1) for month in range(1, last_month_in_rollup(year, self.today) + 1)]
+
+        notes = []
+        month_summaries = [(month, bucket.summarise_month(device, month, self.checksum)) for month in months]
+        expected = concatenate_summaries(usable_sources(month_summaries, notes))
+        actual = bucket.summarise_year(device, date(year, 1, 1), self.checksum)
+        return compare_summaries(expected, actual), notes
+
+    def repair_month(self, device: str, year: int, month: int) -> bool:
+        bucket = get_bucket(self.bucket_name)
+        last_day = last_day_in_rollup(year, month, self.today)
+        month_array = bucket.download_days_in_range(device, year, month, 1, last_day) if last_day else None
+        if month_array is None:
+            print(f'Cannot rebuild {device} {year}-{month:02d} since it has no day data')
+            return False
+        bucket.upload_month(device, date(year, month, 1), month_array)
+        return True
+
+    def rebuild_fleet_month(self, devices: list[str], year: int, month: int):
+        get_bucket(self.bucket_name).upload_fleet_month(date(year, month, 1), devices)
+
+    def repair_year(self, device: str, year: int) -> bool:
+        bucket = get_bucket(self.bucket_name)
+        last_month = last_month_in_rollup(year, self.today)
+        year_array = bucket.download_months_in_range(device, year, 1, last_month) if last_month else None
+        if year_array is None:
+            print(f'Cannot rebuild {device} {year} since it has no month data')
+            return False
+        bucket.upload_year(device, date(year, 1, 1), year_array)
+        return True
+
+
+def run_checks(executor: ThreadPoolExecutor, check, tasks: list[tuple]) -> list[tuple]:
+    """
+    Run check on every task concurrently, print the results and return the
+    tasks that failed.
+    """
+    broken = []
+    for task, (problems, notes) in zip(tasks, executor.map(lambda task: check(*task), tasks)):
+        name = ' '.join(str(part) for part in task)
+        for note in notes:
+            print(f'NOTE     {name}: {note}')
+        if problems:
+            print(f'MISMATCH {name}: {"; ".join(problems)}')
+            broken.append(task)
+    return broken
+
+
+def parse_month(value: str) -> date:
+    year, month = value.split('-')
+    return date(int(year), int(month), 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--from', dest='start', required=True, type=parse_month, help='First month to check (YYYY-MM)')
+    parser.add_argument('--until', dest='end', type=parse_month, help='Last month to check (YYYY-MM), defaults to --from')
+    parser.add_argument('--devices', nargs='+', help='Devices to check')
+    parser.add_argument('--location-table', help='Check every device in this location table instead of --devices')
+    parser.add_argument('--bucket', default=BUCKET_NAME)
+    parser.add_argument('--checksum', action='store_true', help='Also compare time column checksums (downloads everything)')
+    parser.add_argument('--repair', action='store_true', help='Rebuild rollups that do not match their sources')
+    parser.add_argument('--workers', type=int, default=16)
+    args = parser.parse_args()
+
+    if args.location_table:
+        devices = LocationTable(args.location_table).get_all_device_ids()
+    elif args.devices:
+        devices = args.devices
+    else:
+        parser.error('one of --devices or --location-table is required')
+
+    end = args.end or args.start
+    months = []
+    month = args.start
+    while month <= end:
+        months.append((month.year, month.month))
+        month = (month + timedelta(days=32)).replace(day=1)
+    years = sorted({year for year, _ in months})
+
+    verifier = Verifier(args.bucket, args.checksum, date.today())
+    month_tasks = [(device, year, month) for device in devices for year, month in months]
+    year_tasks = [(device, year) for device in devices for year in years]
+
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        print(f'Checking {len(month_tasks)} months for {len(devices)} devices')
+        broken_months = run_checks(executor, verifier.verify_month, month_tasks)
+
+        if args.repair and broken_months:
+            print(f'Rebuilding {len(broken_months)} months')
+            list(executor.map(lambda task: verifier.repair_month(*task), broken_months))
+            # Failed rebuilds and uploads are only printed, so check the results again
+            print(f'Checking the {len(broken_months)} rebuilt months')
+            unrepaired_months = run_checks(executor, verifier.verify_month, broken_months)
+
+            # Fleet months are built from the device months so they are now stale
+            repaired_months = sorted({(year, month) for _, year, month in broken_months})
+            if args.location_table:
+                print(f'Rebuilding {len(repaired_months)} fleet months')
+                list(executor.map(lambda month: verifier.rebuild_fleet_month(devices, *month), repaired_months))
+            else:
+                print('Not rebuilding fleet months without --location-table since they need every device. '
+                      f'Rerun with it to refresh {", ".join(f"{year}-{month:02d}" for year, month in repaired_months)}')
+        else:
+            unrepaired_months = broken_months
+
+        # Years are checked after the months are repaired since they are built from them
+        print(f'Checking {len(year_tasks)} years for {len(devices)} devices')
+        broken_years = run_checks(executor, verifier.verify_year, year_tasks)
+
+        if args.repair and broken_years:
+            print(f'Rebuilding {len(broken_years)} years')
+            list(executor.map(lambda task: verifier.repair_year(*task), broken_years))
+            print(f'Checking the {len(broken_years)} rebuilt years')
+            unrepaired_years = run_checks(executor, verifier.verify_year, broken_years)
+        else:
+            unrepaired_years = broken_years
+
+    print(f'{len(broken_months)} of {len(month_tasks)} months and {len(broken_years)} of {len(year_tasks)} years did not match')
+    if args.repair and (broken_months or broken_years):
+        print(f'{len(unrepaired_months)} months and {len(unrepaired_years)} years still do not match after rebuilding')
+    if unrepaired_months or unrepaired_years:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()